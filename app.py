@@ -7,181 +7,293 @@ Loads credentials from secrets.txt via database.py and uses psycopg2.
 This version includes code to compute real delivery stats and provide `delivery_stats` to the profile template.
 """
 
-import json
 import logging
-import requests
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import psycopg2
 from flask import (
     Flask,
+    Response,
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
     request,
     session,
+    stream_template,
     url_for,
     current_app
 )
+from jinja2 import FileSystemBytecodeCache
 from auth import auth_bp, authenticate
-from config import get_debug_mode, SECRET_KEY
+from config import (
+    DELIVERY_FEE_PERCENTAGE,
+    configure_session_store,
+    get_debug_mode,
+    SECRET_KEY,
+)
 from database import (
-    get_main_db_connection,
-    get_user_db_connection,
+    STEP_INDEX,
+    db_connection,
+    execute_prepared,
     init_user_db,
+    json_dumpb,
+    jsonb,
+)
+from db_utils import (
+    EARNINGS_SQL,
+    CartError,
+    decline_order,
+    get_all_items,
+    get_cart,
+    get_delivery,
+    modify_cart,
+    ojsonify,
+    update_order_claim_status,
+    get_user_cart,
+    timeline_from_bits,
 )
-from db_utils import update_order_claim_status, get_user_cart
 
 logging.basicConfig(level=logging.DEBUG)
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+configure_session_store(app)
 app.register_blueprint(auth_bp)
 
-SERVER_URL = "http://localhost:5150"
-REQUEST_TIMEOUT = 5
-DELIVERY_FEE_PERCENTAGE = 0.1
+# Keep compiled templates on disk so new workers load them instead of
+# compiling, and load them all now so no request pays for a first
+# render
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+# The item catalog rarely changes, so keep a copy for ITEMS_CACHE_TTL
+# seconds instead of loading it from the database on every request
+ITEMS_CACHE_TTL = 60
+_items_cache = {"at": 0.0, "data": None, "by_category": {}}
+
+# Encoded /get_category_items bodies keyed by (category, favorites).
+# Dropped whenever the catalog is reloaded, and capped so many distinct
+# favorite sets cannot grow it without bound.
+CATEGORY_CACHE_MAX = 256
+_category_cache = {}
+
+# Decoded order_details rows kept per process, see load_order_details
+ORDER_CACHE_MAX = 1024
+
+
+# Page views that send a visitor without a session through CAS login
+CAS_ENDPOINTS = frozenset(
+    {
+        "home",
+        "shop",
+        "favorites_view",
+        "shopper_timeline",
+        "category_view",
+        "cart_view",
+        "deliver",
+        "delivery_details",
+        "profile",
+        "order_confirmation",
+        "order_details",
+        "deliverer_timeline",
+    }
+)
+
+
+# Function to read the current user once per request. Views use
+# g.username and g.user_id instead of going back to the session.
+@app.before_request
+def load_user():
+    if request.endpoint in CAS_ENDPOINTS:
+        g.username = authenticate()
+    else:
+        g.username = None
+    g.user_id = session.get("user_id")
+
+
+# Function to get the item catalog, keyed by store code. Callers must
+# treat the returned dict as read-only since it is shared.
+def get_items():
+    now = time.monotonic()
+    if (
+        _items_cache["data"] is not None
+        and now - _items_cache["at"] < ITEMS_CACHE_TTL
+    ):
+        return _items_cache["data"]
+
+    items = get_all_items()
+    by_category = {}
+    for item_id, item in items.items():
+        key = category_key(item.get("category") or "")
+        by_category.setdefault(key, {})[item_id] = item
+
+    _items_cache["data"] = items
+    _items_cache["by_category"] = by_category
+    _items_cache["at"] = now
+    _category_cache.clear()
+    return items
+
+# Function to normalize a category name for lookups; case and spaces
+# are ignored
+def category_key(category):
+    return category.upper().replace(" ", "")
+
+# Function to get the catalog items in one category, keyed by store
+# code. Read-only like get_items(); the grouping is built when the
+# catalog is loaded so a lookup does not scan every item.
+def get_category(category):
+    get_items()
+    return _items_cache["by_category"].get(category_key(category), {})
+
+
+# Function to build the URL of an endpoint without arguments. These
+# never change while the app runs, so each is built only once.
+@lru_cache(maxsize=None)
+def endpoint_url(endpoint):
+    return url_for(endpoint)
+
+
+# Function to price a cart against the item catalog. Returns the
+# subtotal, delivery fee and total shown on the cart pages.
+def cart_totals(cart, items):
+    # A plain loop: no generator frame, and no empty dict built for
+    # items that have left the catalog. Carts are only written by
+    # modify_cart, so every entry is a {"quantity": n} dict.
+    subtotal = 0
+    for item_id, details in cart.items():
+        item = items.get(item_id)
+        if item is not None:
+            subtotal += details["quantity"] * item["price"]
+    delivery_fee = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
+    total = round(subtotal + delivery_fee, 2)
+    return subtotal, delivery_fee, total
+
 
-EST = timezone(timedelta(hours=-5))
+# Princeton local time; the zone handles the EST/EDT switch
+EST = ZoneInfo("America/New_York")
+EST_FORMAT = "%Y-%m-%d %H:%M %Z"
 
 # –––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––
 # User Data Management
 # –––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––
 
 
-# Function to get user data from the user database
-def get_user_data(user_id):
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
 # Function to get user orders from the main database
-def get_user_orders(user_id):
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
+def get_user_orders(user_id, cursor):
+    # Each order comes back with its total already rounded from the
+    # stored subtotal, so rows can go straight to the template
     cursor.execute(
-        "SELECT * FROM orders WHERE user_id = %s ORDER BY timestamp DESC",
+        """
+        SELECT id, timestamp, total_items, status,
+               ROUND(COALESCE(subtotal, 0)::numeric, 2)::float AS total
+        FROM orders WHERE user_id = %s ORDER BY timestamp DESC
+        """,
         (user_id,),
     )
-    orders = cursor.fetchall()
-    conn.close()
-    return orders
-
-# Function to calculate user stats
-def calculate_user_stats(orders):
-    total_spent = 0
-    total_items = 0
-    for order in orders:
-        total_items += order["total_items"]
-        cart = json.loads(order["cart"])
-        subtotal = sum(
-            details.get("quantity", 0) * details.get("price", 0)
-            for details in cart.values()
-        )
-        total_spent += subtotal
+    return cursor.fetchall()
 
-    return {
-        "total_orders": len(orders),
-        "total_spent": round(total_spent, 2),
-        "total_items": total_items,
-    }
-
-# Function to get the average rating of a user for a given role
-def get_average_rating(user_id, role):
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    if role == "deliverer":
-        cursor.execute(
-            """
-            SELECT deliverer_rating_sum AS s, deliverer_rating_count AS c
-            FROM users WHERE user_id = %s
-        """,
-            (user_id,),
-        )
-    else:
-        cursor.execute(
-            """
-            SELECT shopper_rating_sum AS s, shopper_rating_count AS c
-            FROM users WHERE user_id = %s
+# Function to calculate user stats as a shopper and as a deliverer
+def calculate_user_stats(user_id, cursor):
+    """
+    Adds up the user's own orders and the deliveries they completed
+    (status='FULFILLED' and claimed_by=user_id) in one aggregate over
+    both sets of orders.
+    """
+    cursor.execute(
+        f"""
+        SELECT
+            COUNT(*) FILTER (WHERE mine) AS total_orders,
+            COALESCE(SUM(total_items) FILTER (WHERE mine), 0)
+                AS total_items,
+            COALESCE(SUM(subtotal) FILTER (WHERE mine), 0)
+                AS total_spent,
+            COUNT(*) FILTER (WHERE delivered) AS deliveries_completed,
+            COALESCE(SUM(total_items) FILTER (WHERE delivered), 0)
+                AS items_delivered,
+            COALESCE(SUM(earnings) FILTER (WHERE delivered), 0)
+                AS money_made
+        FROM (
+            SELECT total_items, subtotal, {EARNINGS_SQL} AS earnings,
+                   user_id = %(user_id)s AS mine,
+                   claimed_by = %(user_id)s AND status = 'FULFILLED'
+                       AS delivered
+            FROM orders
+            WHERE user_id = %(user_id)s
+               OR (claimed_by = %(user_id)s AND status = 'FULFILLED')
+        ) AS o
         """,
-            (user_id,),
-        )
+        {"user_id": user_id, "fee_rate": DELIVERY_FEE_PERCENTAGE},
+    )
     row = cursor.fetchone()
-    conn.close()
-    if row and row["c"] and row["c"] > 0:
-        return round(row["s"] / row["c"], 1)
-    return None
 
-# Function to update the rating of a user
-def update_rating(user_id, rater_role, rating):
-    if rating < 1 or rating > 5:
-        return False
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
+    stats = {
+        "total_orders": row["total_orders"],
+        "total_spent": round(row["total_spent"], 2),
+        "total_items": row["total_items"],
+    }
+    delivery_stats = {
+        "deliveries_completed": row["deliveries_completed"],
+        "items_delivered": row["items_delivered"],
+        "money_made": round(row["money_made"], 2),
+    }
+    return stats, delivery_stats
 
-    if rater_role == "deliverer":
-        # deliverer being rated by shopper
-        cursor.execute(
-            """
-            UPDATE users
-            SET deliverer_rating_sum = deliverer_rating_sum + %s,
-                deliverer_rating_count = deliverer_rating_count + 1
-            WHERE user_id = %s
-        """,
-            (rating, user_id),
-        )
-    elif rater_role == "shopper":
-        # shopper being rated by deliverer
-        cursor.execute(
-            """
-            UPDATE users
-            SET shopper_rating_sum = shopper_rating_sum + %s,
-                shopper_rating_count = shopper_rating_count + 1
-            WHERE user_id = %s
-        """,
-            (rating, user_id),
-        )
-    else:
-        conn.close()
-        return False
+# Function to turn a rating sum and count into a one-decimal average
+def average_rating(rating_sum, rating_count):
+    if rating_count and rating_count > 0:
+        return round(rating_sum / rating_count, 1)
+    return None
 
-    conn.commit()
-    conn.close()
-    return True
+# Prepared statement that records a rating, by the rater's role
+RATE_STATEMENTS = {
+    "deliverer": "rate_deliverer",
+    "shopper": "rate_shopper",
+}
+
+# Function to update the rating of a user and return their new average.
+# rater is (order_id, rater_id, rater_role). The order checks (rater is
+# on the order, order delivered) run inside the UPDATE, so this returns
+# None instead of rating when any fail.
+def update_rating(cursor, rater, user_id, rating):
+    order_id, rater_id, rater_role = rater
+    delivered_bit = 1 << STEP_INDEX["Delivered"]
+    execute_prepared(
+        cursor,
+        RATE_STATEMENTS[rater_role],
+        (rating, user_id, order_id, rater_id, delivered_bit),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row["avg_rating"]
 
-# Function to get the delivery stats for a deliverer
-def get_delivery_stats(user_id):
-    """
-    Calculate real delivery stats for a deliverer.
-    Consider a delivery completed if status='FULFILLED' and claimed_by=user_id.
-    We'll sum up all earnings from these deliveries.
-    """
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
+# Function to explain why update_rating refused a rating
+def rating_error(cursor, order_id, rater_id, rater_role):
     cursor.execute(
-        "SELECT cart FROM orders WHERE claimed_by = %s AND status = 'FULFILLED'",
-        (user_id,),
+        "SELECT user_id, claimed_by, timeline_bits FROM orders WHERE id = %s",
+        (order_id,),
     )
-    completed_orders = cursor.fetchall()
-    conn.close()
+    order = cursor.fetchone()
+    if not order:
+        return "Order not found", 404
 
-    deliveries_completed = len(completed_orders)
-    money_made = 0.0
-    for order in completed_orders:
-        cart = json.loads(order["cart"])
-        subtotal = sum(
-            item.get("quantity", 0) * item.get("price", 0)
-            for item in cart.values()
-        )
-        earnings = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
-        money_made += earnings
+    delivered_bit = 1 << STEP_INDEX["Delivered"]
+    if not order["timeline_bits"] & delivered_bit:
+        return "Cannot rate before order is delivered", 400
 
-    return {
-        "deliveries_completed": deliveries_completed,
-        "money_made": round(money_made, 2),
-    }
+    if rater_role == "deliverer":
+        allowed = order["claimed_by"] == rater_id
+    else:
+        allowed = order["user_id"] == rater_id
+    if not allowed:
+        return "Not authorized", 403
+
+    return "User not found", 404
 
 
 # –––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––
@@ -192,80 +304,82 @@ def get_delivery_stats(user_id):
 @app.route("/", methods=["GET"])
 @app.route("/index", methods=["GET"])
 def home():
-    username = authenticate()
-    session["user_id"] = username
+    username = g.username
+    g.user_id = session["user_id"] = username
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO users (user_id, name, cart)
-        VALUES (%s, %s, '{}')
-        ON CONFLICT (user_id) DO NOTHING""",
-        (session["user_id"], username),
-    )
-    conn.commit()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Only make sure the user row exists once per session; returning
+        # visitors skip the write (and its commit) on every page view
+        if not session.get("initialized"):
+            cursor.execute(
+                """INSERT INTO users (user_id, name, cart)
+                VALUES (%s, %s, '{}')
+                ON CONFLICT (user_id) DO NOTHING""",
+                (g.user_id, username),
+            )
+            conn.commit()
+            session["initialized"] = True
 
-    cursor.execute(
-        "SELECT phone_number, venmo_handle FROM users WHERE user_id = %s",
-        (session["user_id"],),
-    )
-    user = cursor.fetchone()
-    conn.close()
+        cursor.execute(
+            "SELECT phone_number, venmo_handle FROM users WHERE user_id = %s",
+            (g.user_id,),
+        )
+        user = cursor.fetchone()
 
     if not user["phone_number"] or not user["venmo_handle"]:
-        return redirect(url_for("profile"))
+        return redirect(endpoint_url("profile"))
 
     return render_template("home.html", username=username)
 
 # Route for the shop page
 @app.route("/shop")
 def shop():
-    username = authenticate()
+    username = g.username
     try:
-        response = requests.get(
-            f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        sample_items = response.json()
+        sample_items = get_items()
 
         categories = set()
         for item in sample_items.values():
             db_category = item.get("category", "")
             pretty_category = db_category.replace("_", " ").title()
             categories.add(pretty_category)
-    except (requests.RequestException, ValueError) as e:
+    except psycopg2.Error as e:
         logging.error("Error fetching shop items: %s", str(e))
         flash("Unable to load shop items. Please try again later.")
-        return redirect(url_for("home"))
+        return redirect(endpoint_url("home"))
 
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("auth.login"))
+        return redirect(endpoint_url("auth.login"))
 
     categories = sorted(list(categories))
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM favorites WHERE user_id = %s",
-        (user_id,),
-    )
-    favorite_count = cursor.fetchone()["count"]
-    conn.close()
+    # favorites and orders live in the same database, so fetch the
+    # favorites flag and the current order together in one query. Only
+    # need to know whether any favorite exists, not how many.
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT EXISTS (
+                SELECT 1 FROM favorites WHERE user_id = %(user_id)s
+            ) AS has_favorites, o.id, o.status
+            FROM (SELECT 1) AS one
+            LEFT JOIN LATERAL (
+                SELECT id, status FROM orders
+                WHERE user_id = %(user_id)s AND status IN ('PLACED', 'CLAIMED')
+                ORDER BY timestamp DESC LIMIT 1
+            ) AS o ON TRUE""",
+            {"user_id": user_id},
+        )
+        row = cursor.fetchone()
 
-    if favorite_count > 0:
+    if row["has_favorites"]:
         categories.insert(0, "Favorites")
 
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT * FROM orders
-        WHERE user_id = %s AND status IN ('PLACED', 'CLAIMED')
-        ORDER BY timestamp DESC LIMIT 1""",
-        (user_id,),
-    )
-    current_order = cursor.fetchone()
-    conn.close()
+    current_order = None
+    if row["id"] is not None:
+        current_order = {"id": row["id"], "status": row["status"]}
 
     return render_template(
         "shop.html",
@@ -277,29 +391,25 @@ def shop():
 # Route for the favorites page
 @app.route("/favorites")
 def favorites_view():
-    username = authenticate()
-    user_id = session.get("user_id")
+    username = g.username
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("auth.login"))
+        return redirect(endpoint_url("auth.login"))
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT item_id FROM favorites WHERE user_id = %s", (user_id,)
-    )
-    favorite_items = {str(row["item_id"]) for row in cursor.fetchall()}
-    conn.close()
-
-    response = requests.get(
-        f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-    )
-    all_items = response.json()
-
-    favorite_items_dict = {
-        item_id: item
-        for item_id, item in all_items.items()
-        if item_id in favorite_items
-    }
+    # Join in the database so only the favorite items come back,
+    # instead of filtering the whole catalog in Python
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT i.* FROM favorites f
+            JOIN items i ON i.store_code = f.item_id
+            WHERE f.user_id = %s""",
+            (user_id,),
+        )
+        favorite_items_dict = {
+            row["store_code"]: row for row in cursor.fetchall()
+        }
+    favorite_items = set(favorite_items_dict)
 
     return render_template(
         "category_view.html",
@@ -312,92 +422,64 @@ def favorites_view():
 # Route for the shopper timeline page
 @app.route("/shopper_timeline")
 def shopper_timeline():
-    username = authenticate()
-    user_id = session.get("user_id")
+    username = g.username
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("home"))
-
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT * FROM orders
-        WHERE user_id = %s
-        ORDER BY timestamp DESC LIMIT 1""",
-        (user_id,),
-    )
-    order = cursor.fetchone()
-
-    deliverer_venmo = None
-    deliverer_phone = None
-    deliverer_avg_rating = None
-    if order and order["claimed_by"]:
-        deliverer_avg_rating = get_average_rating(
-            order["claimed_by"], "deliverer"
-        )
+        return redirect(endpoint_url("home"))
 
-    if order and order["claimed_by"]:
-        user_conn = get_user_db_connection()
-        user_cursor = user_conn.cursor()
-        user_cursor.execute(
-            "SELECT venmo_handle, phone_number FROM users WHERE user_id = %s",
-            (order["claimed_by"],),
+    # Fetch the latest order with the deliverer's contact details and
+    # average rating (NULL until someone claims it) in one query
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT o.id, o.timestamp, o.total_items, o.cart,
+                o.location, o.timeline_bits, o.claimed_by,
+                o.shopper_rated,
+                d.venmo_handle AS deliverer_venmo,
+                d.phone_number AS deliverer_phone,
+                ROUND(
+                    d.deliverer_rating_sum::numeric
+                    / NULLIF(d.deliverer_rating_count, 0),
+                    1
+                )::float AS deliverer_avg_rating
+            FROM orders o LEFT JOIN users d ON d.user_id = o.claimed_by
+            WHERE o.user_id = %s
+            ORDER BY o.timestamp DESC LIMIT 1""",
+            (user_id,),
         )
-        deliverer = user_cursor.fetchone()
-        if deliverer:
-            deliverer_venmo = deliverer["venmo_handle"]
-            deliverer_phone = deliverer["phone_number"]
-        user_conn.close()
-
-    conn.close()
+        order = cursor.fetchone()
 
     if not order:
         return "No orders found."
 
-    order_dict = dict(order)
-    order_dict["timeline"] = json.loads(
-        order_dict.get("timeline", "{}")
-    )
-    order_dict["cart"] = json.loads(order_dict.get("cart", "{}"))
-
-    if "timestamp" in order_dict and order_dict["timestamp"]:
-        order_dict["timestamp"] = convert_to_est(
-            order_dict["timestamp"]
-        )
+    # RealDictRow is already a mutable dict, so decode it in place
+    decode_order_view(order)
 
     return render_template(
         "shopper_timeline.html",
-        order=order_dict,
-        deliverer_venmo=deliverer_venmo,
-        deliverer_phone=deliverer_phone,
+        order=order,
+        deliverer_venmo=order["deliverer_venmo"],
+        deliverer_phone=order["deliverer_phone"],
+        deliverer_avg_rating=order["deliverer_avg_rating"],
         username=username,
     )
 
 # Route for the category view page
 @app.route("/category_view/<category>")
 def category_view(category):
-    username = authenticate()
+    username = g.username
     if "user_id" not in session:
-        return redirect(url_for("auth.login"))
-    user_id = session["user_id"]
-
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT item_id FROM favorites WHERE user_id = %s", (user_id,)
-    )
-    favorites = {str(row["item_id"]) for row in cursor.fetchall()}
-    conn.close()
+        return redirect(endpoint_url("auth.login"))
+    user_id = g.user_id
 
-    response = requests.get(
-        f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-    )
-    sample_items = response.json()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT item_id FROM favorites WHERE user_id = %s", (user_id,)
+        )
+        favorites = {str(row["item_id"]) for row in cursor.fetchall()}
 
-    items_in_category = {
-        k: v
-        for k, v in sample_items.items()
-        if v.get("category", "").upper() == category.upper()
-    }
+    items_in_category = get_category(category)
 
     return render_template(
         "category_view.html",
@@ -410,29 +492,15 @@ def category_view(category):
 # Route for the cart view page
 @app.route("/cart_view")
 def cart_view():
-    username = authenticate()
-    user_id = session.get("user_id")
+    username = g.username
+    user_id = g.user_id
     if "user_id" not in session:
-        return redirect(url_for("home"))
+        return redirect(endpoint_url("home"))
 
     try:
         # Fetch items and cart data
-        items_response = requests.get(f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT)
-        cart_response = requests.get(
-            f"{SERVER_URL}/cart",
-            params={"user_id": user_id},
-            timeout=REQUEST_TIMEOUT,
-        )
-
-        # Parse responses
-        sample_items = items_response.json()
-
-        # Check if cart response is valid
-        if cart_response.status_code != 200:
-            logging.error(f"Cart fetch failed: {cart_response.json()}")
-            cart = {}
-        else:
-            cart = cart_response.json()
+        sample_items = get_items()
+        cart = get_cart(user_id) or {}
 
     except Exception as e:
         logging.error(f"Error fetching cart data: {e}")
@@ -440,14 +508,7 @@ def cart_view():
         cart = {}
 
     # Calculate subtotal, delivery fee, and total
-    subtotal = sum(
-        details.get("quantity", 0)
-        * sample_items.get(item_id, {}).get("price", 0)
-        for item_id, details in cart.items()
-        if isinstance(details, dict)
-    )
-    delivery_fee = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
-    total = round(subtotal + delivery_fee, 2)
+    subtotal, delivery_fee, total = cart_totals(cart, sample_items)
 
     return render_template(
         "cart_view.html",
@@ -462,42 +523,37 @@ def cart_view():
 # Function to return the deliverer page (deliver.html)
 @app.route("/deliver")
 def deliver():
-    current_username = authenticate()
-    user_id = session.get("user_id")
+    current_username = g.username
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("home"))
-
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM orders WHERE status = 'PLACED' AND user_id != %s", (user_id,))
-    available_deliveries = cursor.fetchall()
-
-    cursor.execute(
-        """SELECT * FROM orders
-        WHERE status = 'CLAIMED' AND claimed_by = %s""",
-        (user_id,),
-    )
-    my_deliveries = cursor.fetchall()
+        return redirect(endpoint_url("home"))
 
-    available_deliveries = [
-        dict(delivery) for delivery in available_deliveries
-    ]
-    my_deliveries = [dict(delivery) for delivery in my_deliveries]
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-    for delivery in available_deliveries + my_deliveries:
-        cart = json.loads(delivery["cart"])
-        subtotal = sum(
-            item["quantity"] * item.get("price", 0)
-            for item in cart.values()
-        )
-        delivery["earnings"] = round(
-            subtotal * DELIVERY_FEE_PERCENTAGE, 2
+        # Only the columns deliver.html shows
+        params = {"user_id": user_id, "fee_rate": DELIVERY_FEE_PERCENTAGE}
+        cursor.execute(
+            f"""SELECT id, user_id, total_items, location,
+                {EARNINGS_SQL} AS earnings
+            FROM orders
+            WHERE status = 'PLACED' AND user_id != %(user_id)s""",
+            params,
         )
+        available_deliveries = cursor.fetchall()
 
-    conn.close()
+        cursor.execute(
+            f"""SELECT id, user_id, total_items, location,
+                {EARNINGS_SQL} AS earnings
+            FROM orders
+            WHERE status = 'CLAIMED' AND claimed_by = %(user_id)s""",
+            params,
+        )
+        my_deliveries = cursor.fetchall()
 
-    return render_template(
+    # Stream the page so the browser gets the first rows while long
+    # delivery lists are still rendering
+    return stream_template(
         "deliver.html",
         available_deliveries=available_deliveries,
         my_deliveries=my_deliveries,
@@ -507,12 +563,10 @@ def deliver():
 # Function to see the details of a delivery
 @app.route("/delivery/<delivery_id>")
 def delivery_details(delivery_id):
-    current_username = authenticate()
-    response = requests.get(
-        f"{SERVER_URL}/delivery/{delivery_id}", timeout=REQUEST_TIMEOUT
-    )
-    if response.status_code == 200:
-        delivery = response.json()
+    current_username = g.username
+    delivery = get_delivery(delivery_id)
+    if delivery:
+        delivery["timestamp"] = convert_to_est(delivery["timestamp"])
         return render_template(
             "delivery_details.html",
             delivery=delivery,
@@ -523,112 +577,93 @@ def delivery_details(delivery_id):
 # Function to view the profile page
 @app.route("/profile", methods=["GET", "POST"])
 def profile():
-    username = authenticate()
+    username = g.username
     if "user_id" not in session:
-        return redirect(url_for("auth.login"))
-    user_id = session["user_id"]
-
-    user_conn = get_user_db_connection()
-    main_conn = get_main_db_connection()
+        return redirect(endpoint_url("auth.login"))
+    user_id = g.user_id
 
-    user_cursor = user_conn.cursor()
-    main_cursor = main_conn.cursor()
-
-    user_cursor.execute(
-        "SELECT phone_number, venmo_handle FROM users WHERE user_id = %s",
-        (user_id,),
-    )
-    user = user_cursor.fetchone()
+    # users, orders and items share one database, so the whole page is
+    # read over a single connection
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-    if not user["phone_number"] or not user["venmo_handle"]:
-        flash(
-            "You have not yet submitted your phone number and Venmo handle. Please complete your profile before continuing.",
-            "warning",
-        )
+        if request.method == "POST":
+            venmo_handle = request.form.get("venmo_handle")
+            phone_number = request.form.get("phone_number")
+            cursor.execute(
+                """UPDATE users
+                SET venmo_handle = %s, phone_number = %s
+                WHERE user_id = %s""",
+                (venmo_handle, phone_number, user_id),
+            )
+            conn.commit()
+            session.pop("_flashes", None)
+            flash("Profile updated successfully!")
+            return redirect(endpoint_url("profile"))
 
-    if request.method == "POST":
-        venmo_handle = request.form.get("venmo_handle")
-        phone_number = request.form.get("phone_number")
-        user_cursor.execute(
-            """UPDATE users
-            SET venmo_handle = %s, phone_number = %s
-            WHERE user_id = %s""",
-            (venmo_handle, phone_number, user_id),
+        # One read of the user row covers the contact details and both
+        # rating averages
+        cursor.execute(
+            """SELECT venmo_handle, phone_number,
+                deliverer_rating_sum, deliverer_rating_count,
+                shopper_rating_sum, shopper_rating_count
+            FROM users WHERE user_id = %s""",
+            (user_id,),
         )
-        user_conn.commit()
-        user_conn.close()
-        session.pop("_flashes", None)
-        flash("Profile updated successfully!")
-        return redirect(url_for("profile"))
-
-    user_cursor.execute(
-        "SELECT venmo_handle, phone_number FROM users WHERE user_id = %s",
-        (user_id,),
-    )
-    user = user_cursor.fetchone()
+        user = cursor.fetchone()
 
-    user_cursor.execute(
-        "SELECT item_id FROM favorites WHERE user_id = %s", (user_id,)
-    )
-    favorite_item_ids = [
-        row["item_id"] for row in user_cursor.fetchall()
-    ]
-
-    favorite_items = []
-    if favorite_item_ids:
-        placeholder = ",".join(["%s"] * len(favorite_item_ids))
-        query = f"SELECT store_code as id, name, price, category FROM items WHERE store_code IN ({placeholder})"
-        main_cursor.execute(query, favorite_item_ids)
-        favorite_items = main_cursor.fetchall()
-
-    user_conn.close()
-    main_conn.close()
-
-    user_profile = get_user_data(user_id)
-    orders = get_user_orders(user_id)
-    stats = calculate_user_stats(orders)
-
-    orders_with_totals = []
-    for order in orders:
-        cart = json.loads(order["cart"])
-        subtotal = sum(
-            details.get("quantity", 0) * details.get("price", 0)
-            for details in cart.values()
+        needs_completion = (
+            not user["phone_number"] or not user["venmo_handle"]
         )
-        order_data = dict(order)
-        order_data["total"] = round(subtotal, 2)
-        orders_with_totals.append(order_data)
+        if needs_completion:
+            flash(
+                "You have not yet submitted your phone number and Venmo "
+                "handle. Please complete your profile before continuing.",
+                "warning",
+            )
+            # The page only asks for the missing details until they are
+            # in and hides the favorites, history and stats sections, so
+            # skip their queries
+            favorite_items = orders = stats = delivery_stats = None
+        else:
+            cursor.execute(
+                """SELECT i.store_code AS id, i.name, i.price, i.category
+                FROM favorites f JOIN items i ON i.store_code = f.item_id
+                WHERE f.user_id = %s""",
+                (user_id,),
+            )
+            favorite_items = cursor.fetchall()
 
-    deliverer_avg_rating = get_average_rating(user_id, "deliverer")
-    shopper_avg_rating = get_average_rating(user_id, "shopper")
+            orders = get_user_orders(user_id, cursor)
+            stats, delivery_stats = calculate_user_stats(user_id, cursor)
 
-    # Compute delivery stats for the user as a deliverer
-    delivery_stats = get_delivery_stats(user_id)
+    deliverer_avg_rating = average_rating(
+        user["deliverer_rating_sum"], user["deliverer_rating_count"]
+    )
+    shopper_avg_rating = average_rating(
+        user["shopper_rating_sum"], user["shopper_rating_count"]
+    )
 
     return render_template(
         "profile.html",
         username=username,
-        orders=orders_with_totals,
+        orders=orders,
         stats=stats,
-        user_profile=user_profile,
+        user_profile=user,
         venmo_handle=user["venmo_handle"] if user else "",
         phone_number=user["phone_number"] if user else "",
         favorites=favorite_items,
         deliverer_avg_rating=deliverer_avg_rating,
         shopper_avg_rating=shopper_avg_rating,
         delivery_stats=delivery_stats,  # now includes money_made
+        needs_completion=needs_completion,
     )
 
 # Function to confirm an order
 @app.route("/order_confirmation")
 def order_confirmation():
-    username = authenticate()
-    response = requests.get(
-        f"{SERVER_URL}/cart",
-        json={"user_id": session["user_id"]},
-        timeout=REQUEST_TIMEOUT,
-    )
-    items_in_cart = len(response.json())
+    username = g.username
+    items_in_cart = len(get_cart(g.user_id) or {})
     return render_template(
         "order_confirmation.html",
         items_in_cart=items_in_cart,
@@ -652,79 +687,65 @@ def get_category_items():
     if not category:
         return jsonify({"error": "Category not specified"}), 400
 
-    if category == "Favorites":
-        user_id = session.get("user_id")
-        if not user_id:
-            return jsonify({"error": "User not logged in"}), 401
+    user_id = g.user_id
+    if category == "Favorites" and not user_id:
+        return jsonify({"error": "User not logged in"}), 401
 
-        conn = get_user_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT item_id FROM favorites WHERE user_id = %s",
-            (user_id,),
-        )
-        favorite_items = {
-            str(row["item_id"]) for row in cursor.fetchall()
-        }
-        conn.close()
+    favorite_item_ids = set()
+    if user_id:
+        with db_connection() as conn:
+            # Only one column is needed, so skip building a dict per row
+            cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+            cursor.execute(
+                "SELECT item_id FROM favorites WHERE user_id = %s",
+                (user_id,),
+            )
+            favorite_item_ids = {str(item_id) for (item_id,) in cursor}
 
-        response = requests.get(
-            f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-        )
-        all_items = response.json()
+    # The response only depends on the catalog, the category and the
+    # user's favorites, so reuse an already encoded body when we can
+    all_items = get_items()
+    cache_key = (category, frozenset(favorite_item_ids))
+    body = _category_cache.get(cache_key)
+    if body is not None:
+        return Response(body, mimetype="application/json")
+
+    if category == "Favorites":
+        # The favorites read above is both the filter and the marker.
+        # Walk the catalog rather than the set so the order is stable
+        # across workers (set order depends on per-process hashing).
         items_in_category = {
-            k: v for k, v in all_items.items() if k in favorite_items
+            k: dict(v)
+            for k, v in all_items.items()
+            if k in favorite_item_ids
         }
     else:
-        db_category = category.upper()
-        response = requests.get(
-            f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-        )
-        all_items = response.json()
+        # Copy the cached items since is_favorite is set on them below
         items_in_category = {
-            k: v
-            for k, v in all_items.items()
-            if v.get("category", "").replace(" ", "")
-            == db_category.replace(" ", "")
-        }
-
-    user_id = session.get("user_id")
-    favorite_item_ids = set()
-    if user_id:
-        conn = get_user_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT item_id FROM favorites WHERE user_id = %s",
-            (user_id,),
-        )
-        favorite_items = cursor.fetchall()
-        conn.close()
-        favorite_item_ids = {
-            str(row["item_id"]) for row in favorite_items
+            k: dict(v) for k, v in get_category(category).items()
         }
 
     for item_id_str, item in items_in_category.items():
         item["is_favorite"] = item_id_str in favorite_item_ids
 
-    return jsonify({"items": items_in_category})
+    body = json_dumpb({"items": items_in_category})
+    if len(_category_cache) >= CATEGORY_CACHE_MAX:
+        _category_cache.clear()
+    _category_cache[cache_key] = body
+    return Response(body, mimetype="application/json")
 
 # Function to get the items in the cart
 @app.route("/get_cart_data")
 def get_cart_data():
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
             401,
         )
 
-    cart_response = requests.get(
-        f"{SERVER_URL}/cart",
-        json={"user_id": user_id},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    if cart_response.status_code != 200:
+    cart = get_cart(user_id)
+    if cart is None:
         return (
             jsonify(
                 {"success": False, "error": "Failed to fetch cart data"}
@@ -732,22 +753,10 @@ def get_cart_data():
             500,
         )
 
-    items_response = requests.get(
-        f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-    )
-    items = items_response.json()
-
-    cart = cart_response.json()
-    subtotal = sum(
-        details.get("quantity", 0)
-        * items.get(item_id, {}).get("price", 0)
-        for item_id, details in cart.items()
-        if isinstance(details, dict)
-    )
-    delivery_fee = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
-    total = round(subtotal + delivery_fee, 2)
+    items = get_items()
+    subtotal, delivery_fee, total = cart_totals(cart, items)
 
-    return jsonify(
+    return ojsonify(
         {
             "success": True,
             "cart": cart,
@@ -761,21 +770,15 @@ def get_cart_data():
 # Function to get the number of items in the cart
 @app.route("/get_cart_count", methods=["GET"])
 def get_cart_count():
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
             401,
         )
 
-    response = requests.get(
-        f"{SERVER_URL}/cart",
-        params={"user_id": user_id},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-
-    if response.status_code != 200:
+    cart = get_cart(user_id)
+    if cart is None:
         return (
             jsonify(
                 {"success": False, "error": "Failed to fetch cart data"}
@@ -783,13 +786,13 @@ def get_cart_count():
             500,
         )
 
-    items_in_cart = len(response.json())
+    items_in_cart = len(cart)
     return jsonify({"success": True, "cart_count": items_in_cart})
 
 # Function to get the cart status
 @app.route("/get_cart_status", methods=["GET"])
 def get_cart_status():
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
@@ -803,8 +806,8 @@ def get_cart_status():
             404,
         )
 
-    cart = json.loads(user["cart"]) if user["cart"] else {}
-    return jsonify({"success": True, "cart": cart})
+    cart = user["cart"] or {}
+    return ojsonify({"success": True, "cart": cart})
 
 
 # –––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––
@@ -814,89 +817,31 @@ def get_cart_status():
 # Function to add an item to the cart
 @app.route("/add_to_cart/<item_id>", methods=["POST"])
 def add_to_cart(item_id):
-    user_id = session.get("user_id")
+    user_id = g.user_id
 
     if not user_id:
         return jsonify({"error": "User not logged in"}), 401
 
-    headers = {
-        "Content-Type": "application/json",
-    }
-
-    # Send the POST request to the API server
-    payload = {
-        "user_id": user_id,
-        "item_id": item_id,
-        "action": "add"
-    }
-
     try:
-        response = requests.post(
-            f"{SERVER_URL}/cart", headers=headers, json=payload, timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()  # Raise exception for 4xx/5xx responses
-
-        # Attempt to parse JSON response
-        return jsonify(response.json())
-
-    except requests.exceptions.HTTPError as http_err:
-        # Response is an error; try to parse JSON, if fails, return a default error
-        try:
-            error_data = response.json()
-        except ValueError:
-            # The response isn't JSON; just return a generic error
-            error_data = {"error": "Failed to add item"}
-
-        current_app.logger.error(f"HTTP error occurred: {http_err} - {response.text}")
-        return jsonify(error_data), response.status_code
-
+        return ojsonify(modify_cart(user_id, item_id, "add"))
+    except CartError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         current_app.logger.error(f"Error adding item to cart: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
-
-
-
-
 # Function to delete an item from the cart
 @app.route("/delete_item/<item_id>", methods=["POST"])
 def delete_item(item_id):
-    user_id = session["user_id"]
-    response = requests.post(
-        f"{SERVER_URL}/cart",
-        json={"user_id": user_id, "item_id": item_id, "action": "delete"},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    if response.status_code != 200:
+    user_id = g.user_id
+    try:
+        cart = modify_cart(user_id, item_id, "delete")
+    except CartError:
         return jsonify({"success": False, "error": "Failed to delete item"}), 500
 
-    cart_response = requests.get(
-        f"{SERVER_URL}/cart",
-        params={"user_id": user_id},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    if cart_response.status_code != 200:
-        return jsonify({"success": False, "error": "Failed to fetch updated cart"}), 500
-
-    cart = cart_response.json()  # Parse the cart here
-
-    items_response = requests.get(
-        f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-    )
-    items = items_response.json()
-
-    subtotal = sum(
-        details.get("quantity", 0)
-        * items.get(i_id, {}).get("price", 0)
-        for i_id, details in cart.items()
-        if isinstance(details, dict)
-    )
-    delivery_fee = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
-    total = round(subtotal + delivery_fee, 2)
+    subtotal, delivery_fee, total = cart_totals(cart, get_items())
 
-    return jsonify({
+    return ojsonify({
         "success": True,
         "cart": cart,
         "subtotal": f"{subtotal:.2f}",
@@ -907,81 +852,49 @@ def delete_item(item_id):
 # Function to update the cart
 @app.route("/update_cart/<item_id>/<action>", methods=["POST"])
 def update_cart(item_id, action):
-    user_id = session["user_id"]
+    user_id = g.user_id
 
     if action == "increase":
-        response = requests.post(
-            f"{SERVER_URL}/cart",
-            json={"user_id": user_id, "item_id": item_id, "action": "add"},
-            timeout=REQUEST_TIMEOUT,
-        )
+        cart_action, quantity = "add", 0
     elif action == "decrease":
         # First, get the current cart correctly:
-        cart_response = requests.get(
-            f"{SERVER_URL}/cart",
-            params={"user_id": user_id},
-            timeout=REQUEST_TIMEOUT,
-        )
-        if cart_response.status_code != 200:
+        cart = get_cart(user_id)
+        if cart is None:
             return jsonify({"success": False, "error": "Failed to get cart"}), 500
 
-        cart = cart_response.json()
         quantity = cart.get(item_id, {}).get("quantity", 0)
 
         if quantity > 1:
-            response = requests.post(
-                f"{SERVER_URL}/cart",
-                json={"user_id": user_id, "item_id": item_id, "quantity": quantity - 1, "action": "update"},
-                timeout=REQUEST_TIMEOUT,
-            )
+            cart_action, quantity = "update", quantity - 1
         elif quantity == 1:
-            response = requests.post(
-                f"{SERVER_URL}/cart",
-                json={"user_id": user_id, "item_id": item_id, "action": "delete"},
-                timeout=REQUEST_TIMEOUT,
-            )
+            cart_action = "delete"
         else:
             return jsonify({"success": False, "error": "Item not in cart"}), 400
     else:
         return jsonify({"success": False, "error": "Invalid action"}), 400
 
-    if response.status_code != 200:
+    # The updated cart comes back from the write, so totals need no
+    # second read
+    try:
+        updated_cart = modify_cart(user_id, item_id, cart_action, quantity)
+    except CartError:
         return jsonify({"success": False, "error": "Failed to update cart"}), 500
 
-    # Fetch updated cart and items to return updated totals
-    updated_cart_response = requests.get(
-        f"{SERVER_URL}/cart",
-        params={"user_id": user_id},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    if updated_cart_response.status_code != 200:
-        return jsonify({"success": False, "error": "Failed to fetch updated cart"}), 500
-
-    updated_cart = updated_cart_response.json()
-
-    items_response = requests.get(f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT)
-    if items_response.status_code != 200:
+    try:
+        items = get_items()
+    except psycopg2.Error:
         return jsonify({"success": False, "error": "Failed to fetch items"}), 500
 
-    items = items_response.json()
-
     # Recalculate totals
-    subtotal = sum(
-        details.get("quantity", 0) * items.get(i_id, {}).get("price", 0)
-        for i_id, details in updated_cart.items()
-        if isinstance(details, dict)
-    )
-    delivery_fee = round(subtotal * DELIVERY_FEE_PERCENTAGE, 2)
-    total = round(subtotal + delivery_fee, 2)
+    subtotal, delivery_fee, total = cart_totals(updated_cart, items)
 
-    return jsonify({
+    return ojsonify({
         "success": True,
         "cart": updated_cart,
         "subtotal": f"{subtotal:.2f}",
         "delivery_fee": f"{delivery_fee:.2f}",
         "total": f"{total:.2f}"
-    }), 200
+    })
 
 # –––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––––
 # Order Management
@@ -990,33 +903,20 @@ def update_cart(item_id, action):
 # Function to get the order details
 @app.route("/order_details/<int:order_id>")
 def order_details(order_id):
-    current_username = authenticate()
+    current_username = g.username
     if "user_id" not in session:
-        return redirect(url_for("auth.login"))
+        return redirect(endpoint_url("auth.login"))
 
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders WHERE id = %s", (order_id,))
-    order_row = cursor.fetchone()
-    conn.commit()
-    conn.close()
-
-    if not order_row:
+    order = load_order_details(order_id)
+    if not order:
         return "Order not found.", 404
 
-    order = dict(order_row)
-    order["cart"] = json.loads(order.get("cart", "{}"))
-    cart = order["cart"]
-
-    subtotal = sum(
-        details.get("quantity", 0) * details.get("price", 0)
-        for item_id, details in cart.items()
-    )
-
-    if "timestamp" in order and order["timestamp"]:
-        order["timestamp"] = convert_to_est(order["timestamp"])
+    # place_order stores the subtotal, so there is no cart to re-price
+    subtotal = order["subtotal"] or 0
 
-    return render_template(
+    # Stream the page so the header is sent while long carts are still
+    # rendering
+    return stream_template(
         "order_details.html",
         order=order,
         subtotal=subtotal,
@@ -1026,88 +926,89 @@ def order_details(order_id):
 # Function to place an order
 @app.route("/place_order", methods=["POST"])
 def place_order():
-    user_id = session.get("user_id")
+    user_id = g.user_id
     data = request.get_json()
     delivery_location = data.get("delivery_location")
 
     if not delivery_location:
         return jsonify({"error": "Delivery location is required"}), 400
 
-    user_conn = get_user_db_connection()
-    user_cursor = user_conn.cursor()
-    user_cursor.execute(
-        "SELECT cart FROM users WHERE user_id = %s", (user_id,)
-    )
-    user = user_cursor.fetchone()
-    cart = json.loads(user["cart"]) if user and user["cart"] else {}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Read the cart together with the current name and price of just
+        # the items in it, so the order is priced from the items table
+        # rather than a possibly stale copy of the whole catalog
+        cursor.execute(
+            """SELECT u.cart, (
+                SELECT jsonb_object_agg(
+                    i.store_code,
+                    jsonb_build_object('name', i.name, 'price', i.price)
+                )
+                FROM items i
+                WHERE i.store_code IN (SELECT jsonb_object_keys(u.cart))
+            ) AS items
+            FROM users u WHERE u.user_id = %s""",
+            (user_id,),
+        )
+        user = cursor.fetchone()
+        cart = user["cart"] if user and user["cart"] else {}
 
-    if not cart:
-        return jsonify({"error": "Cart is empty"}), 400
+        if not cart:
+            return jsonify({"error": "Cart is empty"}), 400
 
-    items_response = requests.get(
-        f"{SERVER_URL}/items", timeout=REQUEST_TIMEOUT
-    )
-    items = items_response.json()
+        items = user["items"] or {}
 
-    for item_id in cart:
-        item = items.get(item_id)
-        if item:
-            cart[item_id]["price"] = item["price"]
-            cart[item_id]["name"] = item["name"]
-
-    total_items = sum(details["quantity"] for details in cart.values())
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-
-    timeline = {
-        "Order Accepted": False,
-        "Venmo Payment Received": False,
-        "Shopping in U-Store": False,
-        "Checked Out": False,
-        "On Delivery": False,
-        "Delivered": False,
-    }
+        for item_id in cart:
+            item = items.get(item_id)
+            if item:
+                cart[item_id]["price"] = item["price"]
+                cart[item_id]["name"] = item["name"]
 
-    cursor.execute(
-        """INSERT INTO orders
-        (status, user_id, total_items, cart, location, timeline)
-        VALUES (%s, %s, %s, %s, %s, %s)""",
-        (
-            "PLACED",
-            user_id,
-            total_items,
-            json.dumps(cart),
-            delivery_location,
-            json.dumps(timeline),
-        ),
-    )
-
-    conn.commit()
-    conn.close()
+        total_items = sum(details["quantity"] for details in cart.values())
+        subtotal = sum(
+            details["quantity"] * details.get("price", 0)
+            for details in cart.values()
+        )
 
-    user_cursor.execute(
-        "UPDATE users SET cart = '{}' WHERE user_id = %s", (user_id,)
-    )
-    user_conn.commit()
-    user_conn.close()
+        # Insert the order and empty the cart in one statement so they are
+        # sent and committed together. timeline_bits defaults to 0, i.e.
+        # no steps completed yet.
+        cursor.execute(
+            """WITH new_order AS (
+                INSERT INTO orders
+                (status, user_id, total_items, cart, location, subtotal)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING user_id
+            )
+            UPDATE users SET cart = '{}'
+            WHERE user_id = (SELECT user_id FROM new_order)""",
+            (
+                "PLACED",
+                user_id,
+                total_items,
+                jsonb(cart),
+                delivery_location,
+                subtotal,
+            ),
+        )
+        conn.commit()
 
     return jsonify({"success": True}), 200
 
 # Function to see the order status
 @app.route("/order_status/<int:order_id>")
 def order_status(order_id):
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT timeline FROM orders WHERE id = %s", (order_id,)
-    )
-    order = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT timeline_bits FROM orders WHERE id = %s", (order_id,)
+        )
+        order = cursor.fetchone()
 
     if not order:
         return jsonify({"error": "Order not found."}), 404
 
-    timeline = json.loads(order["timeline"])
+    timeline = timeline_from_bits(order["timeline_bits"])
     return jsonify({"timeline": timeline})
 
 
@@ -1118,11 +1019,13 @@ def order_status(order_id):
 # Function to accept a delivery
 @app.route("/accept_delivery/<int:delivery_id>", methods=["POST"])
 def accept_delivery(delivery_id):
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("auth.login"))
+        return redirect(endpoint_url("auth.login"))
 
-    update_order_claim_status(user_id, delivery_id)
+    if not update_order_claim_status(user_id, delivery_id):
+        flash("This delivery has already been claimed.")
+        return redirect(endpoint_url("deliver"))
     return redirect(
         url_for("deliverer_timeline", delivery_id=delivery_id)
     )
@@ -1134,13 +1037,9 @@ def accept_delivery(delivery_id):
     endpoint="decline_delivery",
 )
 def decline_delivery_route(delivery_id):
-    response = requests.post(
-        f"{SERVER_URL}/decline_delivery/{delivery_id}",
-        timeout=REQUEST_TIMEOUT,
-    )
-    if response.status_code == 200:
-        return redirect(url_for("deliver"))
-    return "Error declining delivery", response.status_code
+    if not decline_order(delivery_id):
+        flash("This delivery is no longer available.")
+    return redirect(endpoint_url("deliver"))
 
 # Function to update the checklist on timeline
 @app.route("/update_checklist", methods=["POST"])
@@ -1150,133 +1049,89 @@ def update_checklist():
     step = data.get("step")
     checked = data.get("checked")
 
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
             401,
         )
 
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT timeline, claimed_by FROM orders WHERE id = %s",
-        (order_id,),
-    )
-    order = cursor.fetchone()
-
-    if not order:
-        conn.close()
-        return (
-            jsonify({"success": False, "error": "Order not found"}),
-            404,
-        )
-
-    if order["claimed_by"] != user_id:
-        conn.close()
+    try:
+        step_index = STEP_INDEX[step]
+    except (KeyError, TypeError):
         return (
-            jsonify({"success": False, "error": "Not authorized"}),
-            403,
+            jsonify({"success": False, "error": "Invalid step"}),
+            400,
         )
 
-    timeline = json.loads(order["timeline"])
-    steps = [
-        "Order Accepted",
-        "Venmo Payment Received",
-        "Shopping in U-Store",
-        "Checked Out",
-        "On Delivery",
-        "Delivered",
-    ]
-    step_index = steps.index(step)
-
-    if checked:
-        if step_index > 0:
-            previous_step = steps[step_index - 1]
-            if not timeline.get(previous_step, False):
-                conn.close()
+    # Authorization and the ordering rules are checked in the UPDATE
+    # itself, so the check and the write happen atomically in one
+    # round trip
+    step_bit = 1 << step_index
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if checked:
+            # Previous step must already be complete (no-op for step 0)
+            execute_prepared(
+                cursor,
+                "check_step",
+                (step_bit, order_id, step_bit >> 1, user_id),
+            )
+            error = "Previous step must be completed first."
+        else:
+            # No later step may be complete
+            execute_prepared(
+                cursor,
+                "uncheck_step",
+                (step_bit, order_id, step_index + 1, user_id),
+            )
+            error = "Cannot uncheck step with completed next steps."
+        updated = cursor.fetchone()
+
+        if not updated:
+            # Only a rejected update needs to know why
+            cursor.execute(
+                "SELECT claimed_by FROM orders WHERE id = %s",
+                (order_id,),
+            )
+            order = cursor.fetchone()
+            if not order:
                 return (
-                    jsonify(
-                        {
-                            "success": False,
-                            "error": "Previous step must be completed first.",
-                        }
-                    ),
-                    400,
+                    jsonify({"success": False, "error": "Order not found"}),
+                    404,
                 )
-    else:
-        if any(
-            timeline.get(steps[i], False)
-            for i in range(step_index + 1, len(steps))
-        ):
-            conn.close()
-            return (
-                jsonify(
-                    {
-                        "success": False,
-                        "error": "Cannot uncheck step with completed next steps.",
-                    }
-                ),
-                400,
-            )
+            if order["claimed_by"] != user_id:
+                return (
+                    jsonify({"success": False, "error": "Not authorized"}),
+                    403,
+                )
+            return jsonify({"success": False, "error": error}), 400
 
-    timeline[step] = checked
-    cursor.execute(
-        "UPDATE orders SET timeline = %s WHERE id = %s",
-        (json.dumps(timeline), order_id),
-    )
-    conn.commit()
-    conn.close()
+        conn.commit()
 
+    timeline = timeline_from_bits(updated["timeline_bits"])
     return jsonify({"success": True, "timeline": timeline}), 200
 
 # Function to get the deliverer timeline
 @app.route("/deliverer_timeline/<int:delivery_id>")
 def deliverer_timeline(delivery_id):
-    current_username = authenticate()
-    user_id = session.get("user_id")
+    current_username = g.username
+    user_id = g.user_id
     if not user_id:
-        return redirect(url_for("auth.login"))
-
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders WHERE id = %s", (delivery_id,))
-    order_row = cursor.fetchone()
-    conn.close()
+        return redirect(endpoint_url("auth.login"))
 
-    if not order_row:
+    order = load_order(delivery_id, with_shopper=True)
+    if not order:
         return "Order not found.", 404
 
-    order = dict(order_row)
-    shopper_avg_rating = get_average_rating(order["user_id"], "shopper")
-
-    user_conn = get_user_db_connection()
-    user_cursor = user_conn.cursor()
-    user_cursor.execute(
-        "SELECT venmo_handle, phone_number FROM users WHERE user_id = %s",
-        (order["user_id"],),
-    )
-    shopper = user_cursor.fetchone()
-    if shopper:
-        shopper_venmo = shopper["venmo_handle"]
-        shopper_phone = shopper["phone_number"]
-    else:
-        shopper_venmo = None
-        shopper_phone = None
-    user_conn.close()
-
-    order["timeline"] = json.loads(order.get("timeline", "{}"))
-    order["cart"] = json.loads(order.get("cart", "{}"))
-
-    if "timestamp" in order and order["timestamp"]:
-        order["timestamp"] = convert_to_est(order["timestamp"])
-
-    return render_template(
+    # Stream the page so the header is sent while long carts are still
+    # rendering
+    return stream_template(
         "deliverer_timeline.html",
         order=order,
-        shopper_venmo=shopper_venmo,
-        shopper_phone=shopper_phone,
-        shopper_avg_rating=shopper_avg_rating,
+        shopper_venmo=order["shopper_venmo"],
+        shopper_phone=order["shopper_phone"],
+        shopper_avg_rating=order["shopper_avg_rating"],
         username=current_username,
     )
 
@@ -1287,7 +1142,7 @@ def deliverer_timeline(delivery_id):
 # Function to add an item to favorites
 @app.route("/add_favorite/<item_id>", methods=["POST"])
 def add_favorite(item_id):
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
@@ -1298,16 +1153,11 @@ def add_favorite(item_id):
         "Adding favorite: user_id=%s, item_id=%s", user_id, item_id
     )
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """INSERT INTO favorites (user_id, item_id)
-            VALUES (%s, %s)
-            ON CONFLICT (user_id, item_id) DO NOTHING""",
-            (user_id, item_id),
-        )
-        conn.commit()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            execute_prepared(cursor, "add_favorite", (user_id, item_id))
+            conn.commit()
         return jsonify({"success": True}), 200
     except Exception as e:
         logging.error("Error adding favorite: %s", str(e))
@@ -1315,13 +1165,11 @@ def add_favorite(item_id):
             jsonify({"success": False, "error": "Internal error."}),
             500,
         )
-    finally:
-        conn.close()
 
 # Function to remove an item from favorites
 @app.route("/remove_favorite/<item_id>", methods=["POST"])
 def remove_favorite(item_id):
-    user_id = session.get("user_id")
+    user_id = g.user_id
     if not user_id:
         return (
             jsonify({"success": False, "error": "User not logged in"}),
@@ -1332,14 +1180,11 @@ def remove_favorite(item_id):
         "Removing favorite: user_id=%s, item_id=%s", user_id, item_id
     )
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            "DELETE FROM favorites WHERE user_id = %s AND item_id = %s",
-            (user_id, item_id),
-        )
-        conn.commit()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            execute_prepared(cursor, "remove_favorite", (user_id, item_id))
+            conn.commit()
         return jsonify({"success": True}), 200
     except Exception as e:
         logging.error("Error removing favorite: %s", str(e))
@@ -1347,20 +1192,13 @@ def remove_favorite(item_id):
             jsonify({"success": False, "error": "Internal error."}),
             500,
         )
-    finally:
-        conn.close()
 
 # Function to submit a rating
 @app.route("/submit_rating", methods=["POST"])
 def submit_rating():
-    user_id = session.get("user_id")
-    if not user_id:
-        return (
-            jsonify({"success": False, "error": "Not logged in"}),
-            401,
-        )
-
-    data = request.get_json()
+    # Reject malformed requests first; none of these checks need the
+    # session or the database
+    data = request.get_json(silent=True) or {}
     rated_user_id = data.get("rated_user_id")
     rater_role = data.get("rater_role")
     rating = data.get("rating")
@@ -1372,103 +1210,106 @@ def submit_rating():
             400,
         )
 
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders WHERE id = %s", (order_id,))
-    order = cursor.fetchone()
-
-    if not order:
-        conn.close()
-        return (
-            jsonify({"success": False, "error": "Order not found"}),
-            404,
-        )
+    if rater_role not in RATE_STATEMENTS:
+        return jsonify({"success": False, "error": "Invalid role"}), 400
 
-    timeline = json.loads(order["timeline"])
-    if not timeline.get("Delivered"):
-        conn.close()
+    try:
+        rating = int(rating)
+    except (TypeError, ValueError):
+        rating = 0
+    if rating < 1 or rating > 5:
         return (
-            jsonify(
-                {
-                    "success": False,
-                    "error": "Cannot rate before order is delivered",
-                }
-            ),
+            jsonify({"success": False, "error": "Invalid rating"}),
             400,
         )
 
-    # Authorization check
-    if rater_role == "deliverer":
-        if order["claimed_by"] != user_id:
-            conn.close()
-            return (
-                jsonify({"success": False, "error": "Not authorized"}),
-                403,
-            )
-    elif rater_role == "shopper":
-        if order["user_id"] != user_id:
-            conn.close()
-            return (
-                jsonify({"success": False, "error": "Not authorized"}),
-                403,
-            )
-    else:
-        conn.close()
-        return jsonify({"success": False, "error": "Invalid role"}), 400
-
-    # Update the rating in users table
-    if not update_rating(rated_user_id, rater_role, int(rating)):
-        conn.close()
+    user_id = g.user_id
+    if not user_id:
         return (
-            jsonify(
-                {"success": False, "error": "Rating update failed"}
-            ),
-            500,
+            jsonify({"success": False, "error": "Not logged in"}),
+            401,
         )
 
-    # Mark that this user role has rated
-    if rater_role == "deliverer":
-        cursor.execute(
-            "UPDATE orders SET deliverer_rated = TRUE WHERE id = %s",
-            (order_id,),
-        )
-    else:
-        cursor.execute(
-            "UPDATE orders SET shopper_rated = TRUE WHERE id = %s",
-            (order_id,),
-        )
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Check if both have rated
-    cursor.execute(
-        "SELECT shopper_rated, deliverer_rated FROM orders WHERE id = %s",
-        (order_id,),
-    )
-    row = cursor.fetchone()
-    if row["shopper_rated"] and row["deliverer_rated"]:
-        # Mark order as FULFILLED
-        cursor.execute(
-            "UPDATE orders SET status = 'FULFILLED' WHERE id = %s",
-            (order_id,),
+        # Update the rating in users table; the order is only read
+        # again if the rating was refused
+        new_average = update_rating(
+            cursor, (order_id, user_id, rater_role), rated_user_id, rating
         )
+        if new_average is None:
+            error, status = rating_error(
+                cursor, order_id, user_id, rater_role
+            )
+            return jsonify({"success": False, "error": error}), status
+
+        # Mark that this user role has rated, and fulfil the order in
+        # the same statement if the other side already has
+        execute_prepared(cursor, f"mark_{rater_role}_rated", (order_id,))
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     return (
-        jsonify({"success": True, "redirect_url": url_for("home")}),
+        jsonify({"success": True, "redirect_url": endpoint_url("home")}),
         200,
     )
 
-# Function to convert a UTC datetime to EST
+# Function to convert a UTC datetime to Eastern time. Order timestamps repeat on
+# every reload of the same pages, so remember the formatted strings.
+@lru_cache(maxsize=4096)
 def convert_to_est(dt_utc):
     # dt_utc is already a datetime object with a UTC timezone or naive (assume UTC)
-    if dt_utc.tzinfo is None:
-        # If it's a naive datetime, attach UTC tzinfo
-        dt_utc = dt_utc.replace(tzinfo=timezone.utc)
+    return (
+        dt_utc if dt_utc.tzinfo else dt_utc.replace(tzinfo=timezone.utc)
+    ).astimezone(EST).strftime(EST_FORMAT)
+
+# Function to load an order for the order pages, decoded for their
+# templates. with_shopper adds the shopper's contact details and
+# average rating (from the running totals on users) in the same query.
+def load_order(order_id, with_shopper=False):
+    if with_shopper:
+        statement = "get_timeline_order"
+    else:
+        statement = "get_order_details"
 
-    EST = timezone(timedelta(hours=-5))
-    dt_est = dt_utc.astimezone(EST)
-    return dt_est.strftime("%Y-%m-%d %H:%M EST")
+    with db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        execute_prepared(cursor, statement, (order_id,))
+        order = cursor.fetchone()
+
+    if order:
+        decode_order_view(order)
+    return order
+
+# Function to load an order for order_details. Rows are cached by id
+# and row version: the version changes on every write to the order,
+# and an order regenerated under a reused id gets a new one, so a hit
+# is never stale and no writer has to invalidate anything.
+def load_order_details(order_id):
+    with db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        execute_prepared(cursor, "get_order_version", (order_id,))
+        stamp = cursor.fetchone()
+    if not stamp:
+        return None
+    return _load_order_version(order_id, stamp["version"])
+
+# Function to load one version of an order; see load_order_details.
+# Callers must treat the returned dict as read-only since it is shared.
+@lru_cache(maxsize=ORDER_CACHE_MAX)
+def _load_order_version(order_id, version):  # pylint: disable=unused-argument
+    return load_order(order_id)
+
+# Function to decode an order row for the order pages in one pass:
+# expand the timeline bits, default the cart and format the timestamp
+def decode_order_view(order):
+    order["timeline"] = timeline_from_bits(order["timeline_bits"])
+    order["cart"] = order["cart"] or {}
+    timestamp = order["timestamp"]
+    if timestamp:
+        order["timestamp"] = convert_to_est(timestamp)
+    return order
 
 if __name__ == "__main__":
     init_user_db()
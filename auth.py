@@ -10,7 +10,7 @@ import ssl
 from urllib import parse, request
 from flask import Blueprint, session, redirect, render_template, abort
 import flask
-from database import get_user_db_connection
+from database import db_connection
 
 auth_bp = Blueprint("auth", __name__)
 _CAS_URL = "https://fed.princeton.edu/cas/"
@@ -79,16 +79,10 @@ def authenticate():
     username = username.strip()
     flask.session["username"] = username
 
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "SELECT user_id FROM users WHERE name = %s", (username,)
-    )
-    user = cursor.fetchone()
-
-    if user is None:
-        # Insert user if not exists
+    # Insert user if not exists; users are keyed by their CAS username,
+    # so the conflict check replaces a separate lookup
+    with db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users (user_id, name) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING",
             (username, username),
@@ -96,7 +90,6 @@ def authenticate():
         conn.commit()
 
     user_id = username
-    conn.close()
 
     flask.session["user_id"] = user_id
     return username
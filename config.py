@@ -10,6 +10,9 @@ import secrets
 
 SECRET_KEY = secrets.token_hex(32)
 
+# Share of an order's subtotal paid to the deliverer as a delivery fee
+DELIVERY_FEE_PERCENTAGE = 0.1
+
 # Set debug mode based on environment variable
 def get_debug_mode():
     return os.getenv("FLASK_DEBUG", "False").lower() in (
@@ -17,3 +20,28 @@ def get_debug_mode():
         "1",
         "t",
     )
+
+# Redis URL for server-side sessions; leave unset to keep Flask's
+# signed-cookie sessions
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL")
+
+
+# Store sessions in Redis when SESSION_REDIS_URL is configured
+def configure_session_store(app):
+    """
+    Moves the session into Redis so the cookie carries only a session
+    id and each request does one Redis GET instead of decoding and
+    verifying the whole signed payload.
+    """
+    if not SESSION_REDIS_URL:
+        return
+
+    # Imported lazily so cookie-session deployments neither load nor
+    # need to install them
+    # pylint: disable=import-outside-toplevel,import-error
+    import redis
+    from flask_session import Session
+
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(SESSION_REDIS_URL)
+    Session(app)
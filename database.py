@@ -7,8 +7,43 @@ It reads DB credentials from secrets.txt and constructs a DATABASE_URL.
 
 import os
 import csv
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection
+from psycopg2.extras import Json, RealDictCursor, register_default_jsonb
+from psycopg2.pool import ThreadedConnectionPool
+
+# Cart blobs are (de)serialized on most requests; use orjson when it is
+# installed and fall back to the standard library otherwise
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumpb = orjson.dumps
+
+    def json_dumps(obj):
+        """Serializes obj to a JSON str (orjson returns bytes)."""
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    import json
+
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+    def json_dumpb(obj):
+        """Serializes obj to UTF-8 encoded JSON bytes."""
+        return json.dumps(obj).encode()
+
+# Carts are stored as JSONB: decode them straight to dicts when rows
+# are fetched instead of in every view
+register_default_jsonb(loads=json_loads, globally=True)
+
+
+def jsonb(obj):
+    """Wraps obj so it is bound as a JSONB query parameter."""
+    return Json(obj, dumps=json_dumps)
 
 
 def load_secrets(filename="secrets.txt"):
@@ -35,19 +70,237 @@ DATABASE_URL = (
     f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
+# Delivery steps in the order they must be completed. Step i is stored
+# as bit i of orders.timeline_bits.
+TIMELINE_STEPS = [
+    "Order Accepted",
+    "Venmo Payment Received",
+    "Shopping in U-Store",
+    "Checked Out",
+    "On Delivery",
+    "Delivered",
+]
+# Step name -> bit position in orders.timeline_bits
+STEP_INDEX = {step: index for index, step in enumerate(TIMELINE_STEPS)}
+
+
+# Session settings applied to every connection. With
+# synchronous_commit off a COMMIT returns once the WAL record is
+# queued rather than flushed, so writes stop waiting on an fsync; a
+# crash can lose the last few commits but never corrupts the database.
+CONNECTION_OPTIONS = "-c synchronous_commit=off"
+
+
+# Only adds state to psycopg2's connection, so it has no public methods
+# of its own
+class PreparingConnection(connection):  # pylint: disable=too-few-public-methods
+    """A connection that remembers which statements it has prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Small statements that run on every click or page view. Each pooled
+# connection prepares them once, so later calls skip parsing and
+# planning.
+# name -> (parameter types, statement)
+PREPARED_STATEMENTS = {
+    "add_favorite": (
+        "text, text",
+        """INSERT INTO favorites (user_id, item_id) VALUES ($1, $2)
+        ON CONFLICT (user_id, item_id) DO NOTHING""",
+    ),
+    "remove_favorite": (
+        "text, text",
+        "DELETE FROM favorites WHERE user_id = $1 AND item_id = $2",
+    ),
+    # Ratings only apply when the rater is on the order and it has been
+    # delivered ($5 is the Delivered timeline bit). Both return the
+    # rated user's new average.
+    "rate_deliverer": (
+        "int, text, int, text, int",
+        """UPDATE users u
+        SET deliverer_rating_sum = u.deliverer_rating_sum + $1,
+            deliverer_rating_count = u.deliverer_rating_count + 1
+        FROM orders o
+        WHERE u.user_id = $2 AND o.id = $3 AND o.claimed_by = $4
+            AND o.timeline_bits & $5 <> 0
+        RETURNING ROUND(
+            u.deliverer_rating_sum::numeric / u.deliverer_rating_count, 1
+        )::float AS avg_rating""",
+    ),
+    "rate_shopper": (
+        "int, text, int, text, int",
+        """UPDATE users u
+        SET shopper_rating_sum = u.shopper_rating_sum + $1,
+            shopper_rating_count = u.shopper_rating_count + 1
+        FROM orders o
+        WHERE u.user_id = $2 AND o.id = $3 AND o.user_id = $4
+            AND o.timeline_bits & $5 <> 0
+        RETURNING ROUND(
+            u.shopper_rating_sum::numeric / u.shopper_rating_count, 1
+        )::float AS avg_rating""",
+    ),
+    # Record that one side has rated; the order is fulfilled once the
+    # other side has too. SET reads the row as it was before the update.
+    "mark_deliverer_rated": (
+        "int",
+        """UPDATE orders SET deliverer_rated = TRUE,
+            status = CASE WHEN shopper_rated THEN 'FULFILLED'
+                ELSE status END
+        WHERE id = $1""",
+    ),
+    "mark_shopper_rated": (
+        "int",
+        """UPDATE orders SET shopper_rated = TRUE,
+            status = CASE WHEN deliverer_rated THEN 'FULFILLED'
+                ELSE status END
+        WHERE id = $1""",
+    ),
+    # xmin changes whenever the row is written, so it versions the
+    # order for caching
+    "get_order_version": (
+        "int",
+        "SELECT xmin::text AS version FROM orders WHERE id = $1",
+    ),
+    "get_order_details": (
+        "int",
+        """SELECT id, timestamp, status, total_items, cart, location,
+            subtotal, timeline_bits
+        FROM orders WHERE id = $1""",
+    ),
+    # An order with its shopper's contact details and average rating
+    "get_timeline_order": (
+        "int",
+        """SELECT o.id, o.timestamp, o.user_id, o.total_items, o.cart,
+            o.location, o.timeline_bits, o.deliverer_rated,
+            u.venmo_handle AS shopper_venmo,
+            u.phone_number AS shopper_phone,
+            ROUND(
+                u.shopper_rating_sum::numeric
+                / NULLIF(u.shopper_rating_count, 0),
+                1
+            )::float AS shopper_avg_rating
+        FROM orders o LEFT JOIN users u ON u.user_id = o.user_id
+        WHERE o.id = $1""",
+    ),
+    # Timeline steps can only be changed by the order's deliverer ($4)
+    # and in order: checking needs the previous step ($3) done,
+    # unchecking needs every step from bit $3 on clear
+    "check_step": (
+        "int, int, int, text",
+        """UPDATE orders SET timeline_bits = timeline_bits | $1
+        WHERE id = $2 AND claimed_by = $4 AND timeline_bits & $3 = $3
+        RETURNING timeline_bits""",
+    ),
+    "uncheck_step": (
+        "int, int, int, text",
+        """UPDATE orders SET timeline_bits = timeline_bits & ~$1
+        WHERE id = $2 AND claimed_by = $4 AND timeline_bits >> $3 = 0
+        RETURNING timeline_bits""",
+    ),
+}
+
+
+def execute_prepared(cursor, name, params):
+    """
+    Runs the named statement from PREPARED_STATEMENTS, preparing it on
+    this cursor's connection the first time it is used there.
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        types, statement = PREPARED_STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({types}) AS {statement}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+# Connections are pooled per process rather than opened per request.
+# A request can hold a few at once (e.g. a view plus a helper), so the
+# pool allows several per worker. psycopg2 closes a returned
+# connection once minconn are idle, so keep all of them open; a
+# reopened connection would also lose its prepared statements.
+POOL_MAX_CONN = 10
+POOL_MIN_CONN = POOL_MAX_CONN
+
+# This process's pool and the pid it was created in
+_pool_state = {"pool": None, "pid": None}
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """
+    Returns this process's connection pool, creating it on first use.
+    Keyed on the pid so a forked worker never shares its parent's
+    sockets.
+    """
+    pid = os.getpid()
+    if _pool_state["pid"] != pid:
+        with _pool_lock:
+            if _pool_state["pid"] != pid:
+                _pool_state["pool"] = ThreadedConnectionPool(
+                    POOL_MIN_CONN,
+                    POOL_MAX_CONN,
+                    DATABASE_URL,
+                    connection_factory=PreparingConnection,
+                    cursor_factory=RealDictCursor,
+                    options=CONNECTION_OPTIONS,
+                )
+                _pool_state["pid"] = pid
+    return _pool_state["pool"]
+
 
 def get_main_db_connection():
-    """Establishes and returns a connection to the main database."""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """Checks out a connection to the main database from the pool."""
+    conn = _get_pool().getconn()
     return conn
 
 
 def get_user_db_connection():
     """For this app, main and user database are the same Postgres DB."""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    conn = _get_pool().getconn()
     return conn
 
 
+def release_db_connection(conn):
+    """
+    Returns a connection to the pool. Anything left uncommitted is
+    rolled back so the next user starts outside a transaction; broken
+    connections are discarded instead of reused.
+    """
+    if conn.closed:
+        _get_pool().putconn(conn, close=True)
+        return
+    try:
+        if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        if conn.autocommit:
+            conn.autocommit = False
+    except psycopg2.Error:
+        # The connection cannot be reset; drop it but free its slot
+        _get_pool().putconn(conn, close=True)
+        return
+    _get_pool().putconn(conn)
+
+
+@contextmanager
+def db_connection(autocommit=False):
+    """
+    Checks out a pooled connection for the body of a with block and
+    always hands it back, even on an early return or an exception.
+    Pass autocommit=True for read-only work: no transaction is opened,
+    so there is nothing to commit or roll back when handing it back.
+    """
+    conn = _get_pool().getconn()
+    conn.autocommit = autocommit
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
+
 def init_user_db():
     """
     Initializes the user database with necessary tables.
@@ -63,7 +316,7 @@ def init_user_db():
             name TEXT NOT NULL,
             venmo_handle TEXT,
             phone_number TEXT,
-            cart TEXT DEFAULT '{}',
+            cart JSONB DEFAULT '{}',
             deliverer_rating_sum INTEGER DEFAULT 0,
             deliverer_rating_count INTEGER DEFAULT 0,
             shopper_rating_sum INTEGER DEFAULT 0,
@@ -71,8 +324,75 @@ def init_user_db():
         )
         """
     )
+
+    # Database migration: carts used to be JSON text
+    if _column_type(cursor, "users", "cart") == "text":
+        cursor.execute(
+            """
+            ALTER TABLE users ALTER COLUMN cart DROP DEFAULT,
+            ALTER COLUMN cart TYPE JSONB
+                USING COALESCE(NULLIF(cart, ''), '{}')::jsonb,
+            ALTER COLUMN cart SET DEFAULT '{}'
+            """
+        )
+
+    # Database migration: older carts may hold bare quantities (or
+    # other shapes) instead of {"quantity": n} entries. Rewrite them
+    # so the cart code can index entries directly; entries with no
+    # usable quantity are dropped.
+    cursor.execute(
+        """
+        UPDATE users SET cart = CASE
+            WHEN jsonb_typeof(cart) <> 'object' THEN '{}'::jsonb
+            ELSE (
+                SELECT COALESCE(
+                    jsonb_object_agg(
+                        key, jsonb_build_object('quantity', quantity)
+                    ),
+                    '{}'::jsonb
+                )
+                FROM (
+                    SELECT key, CASE
+                        WHEN jsonb_typeof(value) = 'number'
+                            THEN value
+                        WHEN jsonb_typeof(value->'quantity') = 'number'
+                            THEN value->'quantity'
+                        WHEN value #>> '{}' ~ '^[0-9]+$'
+                            THEN to_jsonb((value #>> '{}')::int)
+                    END AS quantity
+                    FROM jsonb_each(cart)
+                ) AS entries
+                WHERE quantity IS NOT NULL
+            )
+        END
+        WHERE jsonb_typeof(cart) <> 'object'
+            OR EXISTS (
+                SELECT 1 FROM jsonb_each(cart)
+                WHERE jsonb_typeof(value) <> 'object'
+                    OR jsonb_typeof(value->'quantity') IS DISTINCT FROM 'number'
+            )
+        """
+    )
+
+    # Database migration: a covering index on users(user_id) did not
+    # give index-only scans (cart writes keep the visibility map
+    # clear) and stopped rating updates from being HOT; drop it
+    cursor.execute("DROP INDEX IF EXISTS idx_users_contact")
     conn.commit()
-    conn.close()
+    release_db_connection(conn)
+
+
+def _column_type(cursor, table, column):
+    """Returns the data type of table.column, or None if it is missing."""
+    cursor.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = %s AND column_name = %s
+        """,
+        (table, column),
+    )
+    row = cursor.fetchone()
+    return row["data_type"] if row else None
 
 
 def init_main_db():
@@ -104,10 +424,11 @@ def init_main_db():
             timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
             user_id TEXT,
             total_items INTEGER,
-            cart TEXT,
+            cart JSONB,
             location TEXT,
-            timeline TEXT DEFAULT '{}',
             claimed_by TEXT,
+            subtotal DOUBLE PRECISION,
+            timeline_bits SMALLINT NOT NULL DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         )
         """
@@ -121,8 +442,95 @@ def init_main_db():
         "ALTER TABLE orders ADD COLUMN IF NOT EXISTS deliverer_rated BOOLEAN DEFAULT FALSE"
     )
 
+    # Database migration: order carts used to be JSON text
+    if _column_type(cursor, "orders", "cart") == "text":
+        cursor.execute(
+            """
+            ALTER TABLE orders ALTER COLUMN cart TYPE JSONB
+            USING NULLIF(cart, '')::jsonb
+            """
+        )
+
+    # Database migration: store each order's subtotal so pages don't
+    # have to re-parse the cart to price it. Backfill older orders.
+    cursor.execute(
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS subtotal DOUBLE PRECISION"
+    )
+    cursor.execute(
+        """
+        UPDATE orders SET subtotal = (
+            SELECT COALESCE(SUM(
+                COALESCE((item->>'quantity')::numeric, 0)
+                * COALESCE((item->>'price')::numeric, 0)
+            ), 0)
+            FROM json_each(orders.cart::json) AS e(item_id, item)
+        )
+        WHERE subtotal IS NULL AND cart IS NOT NULL
+        """
+    )
+
+    # Database migration: the deliverer's fee used to be a generated
+    # column, which froze the fee percentage into the DDL. It is now
+    # computed from the subtotal when read (db_utils.EARNINGS_SQL).
+    cursor.execute("ALTER TABLE orders DROP COLUMN IF EXISTS delivery_fee")
+
+    # Database migration: keep the timeline as a bitmask of completed
+    # steps. Convert the old JSON timeline column once, then drop it.
+    cursor.execute(
+        """
+        ALTER TABLE orders
+        ADD COLUMN IF NOT EXISTS timeline_bits SMALLINT NOT NULL DEFAULT 0
+        """
+    )
+    if _column_type(cursor, "orders", "timeline") is not None:
+        step_bits = " | ".join(
+            "(CASE WHEN (timeline::json->>%s)::boolean "
+            f"THEN {1 << index} ELSE 0 END)"
+            for index in range(len(TIMELINE_STEPS))
+        )
+        cursor.execute(
+            "UPDATE orders SET timeline_bits = "
+            + step_bits
+            + " WHERE timeline IS NOT NULL AND timeline <> '{}'",
+            TIMELINE_STEPS,
+        )
+        cursor.execute("ALTER TABLE orders DROP COLUMN timeline")
+
+    # Indexes for the hot orders lookups: a shopper's latest orders,
+    # a shopper's current open order (shop page), the deliverer's open
+    # list by status, and a deliverer's claims. Only PLACED and CLAIMED
+    # orders are ever looked up by status, so those indexes skip the
+    # finished ones (one replaces a full index on status).
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_user_ts
+        ON orders (user_id, timestamp DESC)
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_user_open
+        ON orders (user_id, timestamp DESC)
+        WHERE status IN ('PLACED', 'CLAIMED')
+        """
+    )
+    cursor.execute("DROP INDEX IF EXISTS idx_orders_status")
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_status_claimed
+        ON orders (status, claimed_by)
+        WHERE status IN ('PLACED', 'CLAIMED')
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_claimed
+        ON orders (claimed_by, status)
+        """
+    )
+
     conn.commit()
-    conn.close()
+    release_db_connection(conn)
 
 
 def create_favorites_table():
@@ -140,7 +548,7 @@ def create_favorites_table():
         """
     )
     conn.commit()
-    conn.close()
+    release_db_connection(conn)
 
 
 def populate_items_from_csv(filename="items.csv"):
@@ -153,7 +561,7 @@ def populate_items_from_csv(filename="items.csv"):
 
     if not os.path.exists(filename):
         conn.commit()
-        conn.close()
+        release_db_connection(conn)
         return
 
     current_category = None
@@ -187,7 +595,7 @@ def populate_items_from_csv(filename="items.csv"):
                     )
 
     conn.commit()
-    conn.close()
+    release_db_connection(conn)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ from database import (
     init_main_db,
     create_favorites_table,
     populate_items_from_csv,
+    release_db_connection,
 )
 
 # Drop all tables and regenerate them
@@ -33,7 +34,7 @@ def drop_all_tables():
     cursor.execute("DROP TABLE IF EXISTS users")
 
     conn.commit()
-    conn.close()
+    release_db_connection(conn)
 
 # Run the initialization code
 if __name__ == "__main__":
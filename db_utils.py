@@ -5,28 +5,185 @@ Database utility functions for shared database operations.
 """
 
 from typing import Union
-from database import get_main_db_connection, get_user_db_connection
+from flask import Response
+from config import DELIVERY_FEE_PERCENTAGE
+from database import (
+    TIMELINE_STEPS,
+    db_connection,
+    json_dumpb,
+    jsonb,
+)
 
-# Update order status to claimed
+
+# The deliverer's fee on an order, from the subtotal stored at
+# placement and the current DELIVERY_FEE_PERCENTAGE (bound as
+# %(fee_rate)s). Every page that shows earnings uses this so they agree.
+EARNINGS_SQL = (
+    "ROUND((COALESCE(subtotal, 0) * %(fee_rate)s)::numeric, 2)::float"
+)
+
+
+class CartError(Exception):
+    """A rejected cart change, with the HTTP status to respond with."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+# Build a JSON response with the fast encoder. Use it for the item and
+# cart payloads; responses that carry datetimes keep jsonify's format.
+def ojsonify(obj, status: int = 200) -> Response:
+    return Response(
+        json_dumpb(obj), status=status, mimetype="application/json"
+    )
+
+# Expand an order's timeline bitmask into {step: completed}
+def timeline_from_bits(bits: int) -> dict:
+    return {
+        step: bool(bits & (1 << index))
+        for index, step in enumerate(TIMELINE_STEPS)
+    }
+
+# Update order status to claimed. Only a placed order can be claimed,
+# so a claimed or fulfilled order keeps its deliverer and status.
+# Returns the number of orders claimed (0 if someone else got it).
 def update_order_claim_status(
     user_id: Union[str, int], delivery_id: Union[str, int]
-) -> None:
-    conn = get_main_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE orders SET status = 'CLAIMED', claimed_by = %s WHERE id = %s",
-        (user_id, delivery_id),
-    )
-    conn.commit()
-    conn.close()
+) -> int:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE orders SET status = 'CLAIMED', claimed_by = %s
+            WHERE id = %s AND status = 'PLACED'""",
+            (user_id, delivery_id),
+        )
+        conn.commit()
+    return cursor.rowcount
 
 # Get user cart data
 def get_user_cart(user_id):
-    conn = get_user_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT cart FROM users WHERE user_id = %s", (user_id,)
-    )
-    user = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT cart FROM users WHERE user_id = %s", (user_id,)
+        )
+        user = cursor.fetchone()
     return user
+
+# Get all items keyed by store code
+def get_all_items() -> dict:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM items")
+        items = cursor.fetchall()
+    return {item["store_code"]: dict(item) for item in items}
+
+# Get a user's cart, or None if the user does not exist
+def get_cart(user_id):
+    user = get_user_cart(user_id)
+    if user is None:
+        return None
+    return user["cart"] or {}
+
+# Apply a cart action ("add", "delete" or "update") and save the cart
+def modify_cart(user_id, item_id, action, quantity=0) -> dict:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT cart FROM users WHERE user_id = %s", (user_id,)
+        )
+        user = cursor.fetchone()
+        if user is None:
+            raise CartError("User not found", 404)
+        cart = user["cart"] or {}
+
+        # Check if item exists
+        cursor.execute("SELECT 1 FROM items WHERE store_code = %s", (item_id,))
+        if not cursor.fetchone():
+            raise CartError("Item not found in inventory", 404)
+
+        if action == "add":
+            cart[item_id] = {
+                "quantity": cart.get(item_id, {}).get("quantity", 0) + 1
+            }
+        elif action == "delete":
+            cart.pop(item_id, None)
+        elif action == "update":
+            if quantity > 0:
+                cart[item_id] = {"quantity": quantity}
+            else:
+                cart.pop(item_id, None)
+        else:
+            raise CartError("Invalid action", 400)
+
+        cursor.execute(
+            "UPDATE users SET cart = %s WHERE user_id = %s",
+            (jsonb(cart), user_id),
+        )
+        conn.commit()
+    return cart
+
+# Fetch detailed cart
+def fetch_detailed_cart(cart, cursor_orders):
+    detailed_cart = {}
+    subtotal = 0
+    for item_id, item_info in cart.items():
+        cursor_orders.execute(
+            "SELECT name, price FROM items WHERE store_code = %s",
+            (item_id,),
+        )
+        item_data = cursor_orders.fetchone()
+        if item_data:
+            item_price = item_data["price"]
+            quantity = item_info["quantity"]
+            item_total = quantity * item_price
+            subtotal += item_total
+            detailed_cart[item_id] = {
+                "name": item_data["name"],
+                "price": item_price,
+                "quantity": quantity,
+                "total": item_total,
+            }
+    return detailed_cart, subtotal
+
+# Get a placed order priced for a deliverer, or None if it is missing
+def get_delivery(delivery_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT id, timestamp, user_id, total_items, cart, location,
+                {EARNINGS_SQL} AS earnings
+            FROM orders WHERE id = %(id)s""",
+            {"id": delivery_id, "fee_rate": DELIVERY_FEE_PERCENTAGE},
+        )
+        order = cursor.fetchone()
+        if not order:
+            return None
+
+        detailed_cart, subtotal = fetch_detailed_cart(
+            order["cart"] or {}, cursor
+        )
+    return {
+        "id": order["id"],
+        "timestamp": order["timestamp"],
+        "user_id": order["user_id"],
+        "total_items": order["total_items"],
+        "cart": detailed_cart,
+        "location": order["location"],
+        "subtotal": round(subtotal, 2),
+        "earnings": order["earnings"],
+    }
+
+# Mark an order as declined. Only a placed order can be declined.
+# Returns the number of orders declined.
+def decline_order(delivery_id) -> int:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE orders SET status = 'DECLINED'
+            WHERE id = %s AND status = 'PLACED'""",
+            (delivery_id,),
+        )
+        conn.commit()
+    return cursor.rowcount
@@ -8,8 +8,14 @@
 cd /home/app/tigercart
 . tigercart_env/bin/activate
 
+# Each worker serves several requests at once on threads so a request
+# waiting on PostgreSQL does not hold up the rest; keep threads within
+# the per-process connection pool (POOL_MAX_CONN in database.py)
+
 # Start server.py on port 5150
-gunicorn --bind 127.0.0.1:5150 server:app --workers 5 &
+gunicorn --bind 127.0.0.1:5150 server:app --workers 5 \
+    --worker-class gthread --threads 4 &
 
 # Start app.py on port 8000
-gunicorn --bind 127.0.0.1:8000 app:app --workers 5
+gunicorn --bind 127.0.0.1:8000 app:app --workers 5 \
+    --worker-class gthread --threads 4